@@ -1,13 +1,14 @@
 import os
-import pwd
-import grp
 import sys
 import typer
 from random import randint
 from typing_extensions import Annotated
-from rich import print
 import subprocess
 import getpass
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 GROUP = "docker"
 FAIL2BAN_CONFIG_FILE = "./fail2ban.conf"
@@ -16,26 +17,49 @@ COWRIE_DB_FILE = "./cowrie.db"
 COWRIE_SSH_PORT = "22"
 CRON_FILE = "./cron.conf"
 DEBUG = False
+# check_root() requires root, sudo is only kept for completeness
+SUDO = [] if os.geteuid() == 0 else ["sudo"]
 
+PREFIX = {
+    "error": "[red][{}][/]",
+    "warning": "[yellow][{}][/]",
+    "info": "[purple][{}][/]",
+}
 
-def print_error(category, message: str, debug: bool = False, exit_after=True) -> None:
-    if debug:
-        category = f"{category} (DEBUG)"
-    print(f"[red][{category}][/] {message}")
+
+@lru_cache(maxsize=1)
+def get_console():
+    # rich is imported on first use, it is slow to import
+    from rich.console import Console
+
+    return Console(highlight=False)
+
+def print_error(category, message: str, exit_after=True) -> None:
+    get_console().print(PREFIX["error"].format(category), message)
     if exit_after:
         sys.exit(1)
 
 
-def print_warning(category, message: str, debug: bool = False) -> None:
-    if debug:
-        category = f"{category} (DEBUG)"
-    print(f"[yellow][{category}][/] {message}")
+def print_warning(category, message: str) -> None:
+    get_console().print(PREFIX["warning"].format(category), message)
 
 
-def print_info(category, message: str, debug: bool = False) -> None:
-    if debug:
-        category = f"{category} (DEBUG)"
-    print(f"[purple][{category}][/] {message}")
+def print_info(category, message: str) -> None:
+    get_console().print(PREFIX["info"].format(category), message)
+
+
+def _print_error_debug(category, message: str, exit_after=True) -> None:
+    get_console().print(PREFIX["error"].format(f"{category} (DEBUG)"), message)
+    if exit_after:
+        sys.exit(1)
+
+
+def _print_warning_debug(category, message: str) -> None:
+    get_console().print(PREFIX["warning"].format(f"{category} (DEBUG)"), message)
+
+
+def _print_info_debug(category, message: str) -> None:
+    get_console().print(PREFIX["info"].format(f"{category} (DEBUG)"), message)
 
 
 def check_root():
@@ -43,9 +67,19 @@ def check_root():
         return True
     print_error("REQUIREMENTS", "Please run this script as root")
 
+@lru_cache(maxsize=1)
+def _os_id() -> str:
+    if not os.path.exists("/etc/os-release"):
+        return ""
+    with open("/etc/os-release", "r") as os_release:
+        for line in os_release:
+            if line.startswith("ID="):
+                return line[3:].strip().strip("\"'").lower()
+    return ""
+
 def check_os():
     if sys.platform.startswith("linux"): 
-        if 'ubuntu' not in os.popen('cat /etc/os-release').read().lower():
+        if _os_id() != "ubuntu":
             print_warning("REQUIREMENTS", "This script was tested on Ubuntu 22.04. It may not work on other OS versions.")
         
         return True
@@ -57,45 +91,59 @@ def check_os():
 def get_random_ssh_port():
     return randint(1024, 10000)
 
-def create_group(group: str):
+@lru_cache(maxsize=128)
+def _group_exists(group: str) -> bool:
+    import grp
+
     try:
         grp.getgrnam(group)
-        print_warning("GROUP", f"{group} already exists, proceeding...")
+        return True
     except KeyError:
-        os.system(f"sudo groupadd {group}")
-        print_info("GROUP", f"{group} created.")
+        return False
+
+@lru_cache(maxsize=128)
+def _user_exists(user: str) -> bool:
+    import pwd
 
-def create_user(user: str, group: str):
     try:
         pwd.getpwnam(user)
-        print_warning("USER", f"{user} already exists, proceeding...")
+        return True
     except KeyError:
-        os.system(f"sudo useradd -m {user} -s /bin/bash")
-        os.system(f"sudo usermod -aG {group} {user}")
-        
+        return False
+
+def create_group(group: str):
+    if _group_exists(group):
+        print_warning("GROUP", f"{group} already exists, proceeding...")
+    else:
+        subprocess.run(SUDO + ["groupadd", group])
+        _group_exists.cache_clear()
+        print_info("GROUP", f"{group} created.")
+
+def create_user(user: str, group: str):
+    if _user_exists(user):
+        print_warning("USER", f"{user} already exists, proceeding...")
+    else:
+        subprocess.run(SUDO + ["useradd", "-m", "-G", group, user, "-s", "/bin/bash"])
+        _user_exists.cache_clear()
         print_info("USER", f"{user} created.")
 
 def create_folder(folder: str):
-    try:
-        os.makedirs(folder)
-        print_info("FOLDER", f"{folder} created.")
-    except FileExistsError:
+    if os.path.lexists(folder):
         print_warning("FOLDER", f"{folder} already exists, proceeding...")
+        return
+    os.makedirs(folder)
+    print_info("FOLDER", f"{folder} created.")
 
 def chown_folder(folder: str, user: str):
-    os.system(f"sudo chown {user}:{user} {folder}")
+    shutil.chown(folder, user, user)
     print_info("FOLDER", f"{folder} permissions set to {user}")
 
-def chmod_file(file: str, mode: str):
-    os.system(f"sudo chmod {mode} {file}")
-    print_info("FILE", f"{file} permissions set to {mode}")
-
 def create_symlink(source: str, destination: str):
-    try:
-        os.symlink(source, destination)
-        print_info("SYMLINK", f"{source} symlinked to {destination}")
-    except FileExistsError:
+    if os.path.lexists(destination):
         print_warning("SYMLINK", f"{destination} already exists, proceeding...")
+        return
+    os.symlink(source, destination)
+    print_info("SYMLINK", f"{source} symlinked to {destination}")
 
 def create_deployment_folder(folder: str, user: str):
     destination = f"/opt/{folder}"
@@ -105,33 +153,42 @@ def create_deployment_folder(folder: str, user: str):
     chown_folder(destination, user)
     chown_folder(home_destination, user)
     
-def create_file(file: str):
-    try:
-        os.system(f"touch {file}")
-        print_info("FILE", f"{file} created.")
-    except FileExistsError:
-        print_warning("FILE", f"{file} already exists, proceeding...")
+def append_file(source: str, destination: str):
+    with open(source, "rb") as src, open(destination, "r+b") as dst:
+        size = os.fstat(src.fileno()).st_size
+        src_offset = 0
+        dst_offset = os.fstat(dst.fileno()).st_size
+        try:
+            # explicit offsets since copy_file_range refuses O_APPEND descriptors
+            while src_offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - src_offset, src_offset, dst_offset)
+                if not copied:
+                    break
+                src_offset += copied
+                dst_offset += copied
+        except (AttributeError, OSError):
+            # copy_file_range is Linux only and not supported across every filesystem
+            src.seek(src_offset)
+            dst.seek(dst_offset)
+            shutil.copyfileobj(src, dst)
 
 def generate_ssh_key_pair(user: str):
-    ssh_key_path = f"/home/{user}/.ssh/id_rsa"
+    ssh_key_path = f"/home/{user}/.ssh/id_ed25519"
     ssh_pub_key_path = f"{ssh_key_path}.pub"
     if not os.path.isfile(ssh_key_path):
-        os.system(f"sudo -u {user} ssh-keygen -t rsa -b 4096 -f {ssh_key_path} -N ''")
+        subprocess.run(["sudo", "-u", user, "ssh-keygen", "-t", "ed25519", "-f", ssh_key_path, "-N", "", "-C", "setup"])
         print_info("USER", "SSH key pair generated.")
     else:
         print_warning("USER", "SSH key pair already exists, proceeding...")
 
     authorized_keys_path = f"/home/{user}/.ssh/authorized_keys"
-    if not os.path.isfile(authorized_keys_path):
-        create_file(authorized_keys_path)
-        chmod_file(authorized_keys_path, "600")
+    try:
+        os.close(os.open(authorized_keys_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
         print_info("USER", "*authorized_keys* file created.")
-    else:
+    except FileExistsError:
         print_warning("USER", "*authorized_keys* file already exists, proceeding...")
 
-    with open(ssh_pub_key_path, "r") as ssh_pub_key:
-        with open(authorized_keys_path, "a") as authorized_keys:
-            authorized_keys.write(ssh_pub_key.read())
+    append_file(ssh_pub_key_path, authorized_keys_path)
 
 def update_ssh_config(ssh_port: str):
     ssh_config_file = "/etc/ssh/sshd_config"
@@ -141,26 +198,48 @@ def update_ssh_config(ssh_port: str):
     if not os.path.isfile(ssh_config_file):
         print_error("SSH", f"SSH config file not found: {ssh_config_file}")
     
-    with open(ssh_config_file, "r") as ssh_config:
-        lines = ssh_config.readlines()
-        for i, line in enumerate(lines):
-            if line.lower().startswith("#port 22"):
-                lines[i] = f"Port {ssh_port}\n"
-                break
-            
-            elif line.lower().startswith("port "):
-                current_port = line.split(" ")[1].strip()
-                break
-    
-    if current_port == default_ssh_port:
-        with open(ssh_config_file, "w") as ssh_config:
-            ssh_config.writelines(lines)
-            print_info("SSH", f"SSH server port changed to {ssh_port}")
-    
-        os.system("sudo systemctl restart sshd")
-        print_info("SSH", "SSH server restarted.")
-    else:
-        print_warning("SSH", f"Port is already set to {current_port}, proceeding...")
+    modified = False
+    with open(ssh_config_file, "rb") as ssh_config:
+        new_ssh_config = tempfile.NamedTemporaryFile(
+            "wb", dir=os.path.dirname(ssh_config_file), delete=False
+        )
+        try:
+            with new_ssh_config:
+                for line in ssh_config:
+                    if line[:5].lower() == b"port ":
+                        current_port = line.split(b" ")[1].strip().decode()
+                    elif line[:8].lower() != b"#port 22":
+                        new_ssh_config.write(line)
+                        continue
+
+                    if current_port == default_ssh_port:
+                        line = f"Port {ssh_port}\n".encode()
+                        modified = True
+                    new_ssh_config.write(line)
+                    # only the first Port line matters, copy the rest untouched
+                    shutil.copyfileobj(ssh_config, new_ssh_config)
+                    break
+
+            if modified:
+                shutil.copymode(ssh_config_file, new_ssh_config.name)
+                os.replace(new_ssh_config.name, ssh_config_file)
+        except BaseException:
+            # never leave a partial copy of the config behind in /etc/ssh
+            os.unlink(new_ssh_config.name)
+            raise
+
+    if not modified:
+        os.unlink(new_ssh_config.name)
+        if current_port == default_ssh_port:
+            print_warning("SSH", f"No Port directive found in {ssh_config_file}, proceeding...")
+        else:
+            print_warning("SSH", f"Port is already set to {current_port}, proceeding...")
+        return
+
+    print_info("SSH", f"SSH server port changed to {ssh_port}")
+
+    subprocess.run(SUDO + ["systemctl", "restart", "sshd"])
+    print_info("SSH", "SSH server restarted.")
 
 def main(
     user: Annotated[str, typer.Argument(help="User used to deploy the app")],
@@ -185,18 +264,32 @@ def main(
     cron_file: Annotated[str, typer.Option(help="Cron file")] = CRON_FILE,
     debug: Annotated[bool, typer.Option(help="Enable debug mode")] = DEBUG,
 ):
+    global print_error, print_warning, print_info
+    if debug:
+        print_error = _print_error_debug
+        print_warning = _print_warning_debug
+        print_info = _print_info_debug
+
     print_info("INFO", "Starting setup...")
     
     check_os()
     check_root()
 
-    create_group(GROUP)
-    create_user(user, GROUP)
+    # every step is bound by the subprocesses it waits on, so threads are enough
+    # to overlap the ssh key generation with the remaining setup
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        ssh_config = executor.submit(update_ssh_config, ssh_port)
 
-    create_deployment_folder(folder, user)
+        create_group(GROUP)
+        create_user(user, GROUP)
 
-    generate_ssh_key_pair(user)
-    update_ssh_config(ssh_port)
+        steps = [
+            executor.submit(create_deployment_folder, folder, user),
+            executor.submit(generate_ssh_key_pair, user),
+            ssh_config,
+        ]
+        for step in steps:
+            step.result()
 
 
 if __name__ == "__main__":